@@ -1,22 +1,42 @@
 # server.py - FINAL FULL VERSION
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import (
+    BulkWriteError,
+    CollectionInvalid,
+    DuplicateKeyError,
+    OperationFailure,
+)
 import os
 import re
+import sys
+import json
+import random
+import time
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone, timedelta, time as dt_time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from passlib.context import CryptContext
 import jwt
-from math import floor
+from math import floor, ceil
+from bisect import bisect_right
+from functools import lru_cache
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
 import firebase_admin
 from firebase_admin import credentials, messaging
+from firebase_admin import exceptions as firebase_exceptions
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # --- CONFIGURATION ---
@@ -69,6 +89,138 @@ def verify_password(plain, hashed) -> bool:
     return pwd_context.verify(plain, hashed)
 
 
+# --- RATE LIMITING & ADMISSION CONTROL ---
+
+
+def _rate_from_env(name: str, default: str):
+    """Parses a '<burst>/<seconds>' rate such as '5/60' from the environment."""
+    burst, seconds = os.environ.get(name, default).split("/")
+    return int(burst), float(seconds)
+
+
+class TokenBucket:
+    """Classic token bucket: 'capacity' tokens, refilled evenly over 'period' seconds."""
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.refill_rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Consumes one token. Returns 0 if allowed, else seconds until a token frees up."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.refill_rate
+        )
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.refill_rate
+
+
+class RateLimiter:
+    """One token bucket per key (IP or email), bounded by LRU eviction."""
+
+    MAX_KEYS = 50_000
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+        self.buckets = OrderedDict()
+
+    def hit(self, key: str) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_KEYS:
+                # O(1): drop the least recently used bucket
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[key] = TokenBucket(self.capacity, self.period)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take()
+
+
+# Per-route limits, configurable via env as '<burst>/<seconds>'
+AUTH_RATE_LIMITS = {
+    "register": {
+        "ip": RateLimiter(*_rate_from_env("RATE_LIMIT_REGISTER_IP", "5/60")),
+        "email": RateLimiter(*_rate_from_env("RATE_LIMIT_REGISTER_EMAIL", "3/60")),
+    },
+    "login": {
+        "ip": RateLimiter(*_rate_from_env("RATE_LIMIT_LOGIN_IP", "20/60")),
+        "email": RateLimiter(*_rate_from_env("RATE_LIMIT_LOGIN_EMAIL", "5/60")),
+    },
+}
+
+# Behind a reverse proxy, set TRUSTED_PROXY_HEADER (e.g. X-Forwarded-For) and
+# TRUSTED_PROXY_COUNT to the number of proxies that append to it
+TRUSTED_PROXY_HEADER = os.environ.get("TRUSTED_PROXY_HEADER")
+TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", "1"))
+
+# Global cap on bcrypt work running at once; excess calls are shed, not queued
+HASH_CONCURRENCY = int(os.environ.get("HASH_CONCURRENCY", "4"))
+hash_slots = asyncio.Semaphore(HASH_CONCURRENCY)
+
+# Rejection counters keyed by "<route>:<reason>", exposed on /admin/rate-limits
+rate_limit_rejections = Counter()
+
+
+def reject_request(route: str, reason: str, retry_after: float):
+    """Counts the rejection and fails fast with 429 + Retry-After."""
+    rate_limit_rejections[f"{route}:{reason}"] += 1
+    raise HTTPException(
+        status_code=429,
+        detail="Too many attempts. Slow down.",
+        headers={"Retry-After": str(max(1, ceil(retry_after)))},
+    )
+
+
+def client_ip(request: Request) -> str:
+    """
+    Client address for rate limiting. With a trusted proxy header configured,
+    takes the entry appended by our outermost proxy; left-hand entries are
+    client-controlled and can be spoofed.
+    """
+    if TRUSTED_PROXY_HEADER:
+        hops = [
+            h.strip()
+            for h in request.headers.get(TRUSTED_PROXY_HEADER, "").split(",")
+            if h.strip()
+        ]
+        if len(hops) >= TRUSTED_PROXY_COUNT:
+            return hops[-TRUSTED_PROXY_COUNT]
+    return request.client.host if request.client else "unknown"
+
+
+def enforce_rate_limit(route: str, request: Request, email: str):
+    """Checks both the per-IP and per-email buckets for an auth route."""
+    limits = AUTH_RATE_LIMITS[route]
+    ip = client_ip(request)
+
+    wait = limits["ip"].hit(ip)
+    if wait:
+        reject_request(route, "ip", wait)
+
+    wait = limits["email"].hit(email.lower())
+    if wait:
+        reject_request(route, "email", wait)
+
+
+async def run_hash_op(route: str, fn, *args):
+    """
+    Runs a bcrypt call in the threadpool under the global concurrency cap,
+    so hashing never blocks the event loop for the rest of the API.
+    """
+    if hash_slots.locked():
+        reject_request(route, "concurrency", 1)
+
+    async with hash_slots:
+        return await run_in_threadpool(fn, *args)
+
+
 def create_access_token(data: dict):
     """Creates a JWT token with a 7-day expiration."""
     to_encode = data.copy()
@@ -109,83 +261,99 @@ async def get_admin_user(current_user: dict = Depends(get_current_user)):
     return current_user
 
 
+# --- PROGRESSION RULES ---
+# Versioned threshold tables. Bump "version" whenever a table changes and the
+# recompute job brings every stored level/badge list in line with it.
+# Override with a JSON file of the same shape via PROGRESSION_RULES_PATH.
+
+DEFAULT_PROGRESSION_RULES = {
+    "version": 1,
+    "xp_per_level": 100,
+    "completion_xp": 20,
+    "shield_cost": 200,
+    # [min_level, title]
+    "titles": [
+        [1, "NEON PHANTOM"],  # Beginner
+        [5, "COBALT STRIKER"],  # Progressing
+        [10, "CYBER VANGUARD"],  # Intermediate
+        [15, "PLASMA EXECUTOR"],  # Advanced
+        [20, "TITAN ARCHITECT"],  # Elite
+        [25, "VOID OVERLORD"],  # Master
+        [30, "SOLAR DEITY"],  # Max Rank
+    ],
+    # [min_xp, badge]
+    "badges": [
+        [0, "Beginner"],
+        [200, "Novice"],
+        [1000, "Intermediate"],
+        [2500, "Expert"],
+        [5000, "Master"],
+    ],
+}
+
+
+class ProgressionRules:
+    """Threshold tables pre-split into sorted key lists for bisect lookups."""
+
+    REQUIRED = ("version", "xp_per_level", "completion_xp", "shield_cost")
+
+    def __init__(self, raw: dict):
+        missing = [k for k in (*self.REQUIRED, "titles", "badges") if k not in raw]
+        if missing:
+            raise ValueError(f"progression rules: missing {', '.join(missing)}")
+        for key in self.REQUIRED:
+            if not isinstance(raw[key], int) or raw[key] < 0:
+                raise ValueError(f"progression rules: {key} must be an integer >= 0")
+        if raw["xp_per_level"] == 0:
+            raise ValueError("progression rules: xp_per_level must be > 0")
+
+        self.version = raw["version"]
+        self.xp_per_level = raw["xp_per_level"]
+        self.completion_xp = raw["completion_xp"]
+        self.shield_cost = raw["shield_cost"]
+        self.title_levels, self.title_names = self._table(raw, "titles")
+        self.badge_xp, self.badge_names = self._table(raw, "badges")
+
+    @staticmethod
+    def _table(raw: dict, key: str):
+        """Splits [[threshold, name], ...] after checking it's strictly ascending."""
+        rows = raw[key]
+        if not rows or not all(
+            isinstance(r, list) and len(r) == 2 and isinstance(r[0], int) for r in rows
+        ):
+            raise ValueError(
+                f"progression rules: {key} must be [[threshold, name], ...]"
+            )
+        thresholds = [r[0] for r in rows]
+        if any(a >= b for a, b in zip(thresholds, thresholds[1:])):
+            raise ValueError(f"progression rules: {key} thresholds must be ascending")
+        return thresholds, [r[1] for r in rows]
+
+
+@lru_cache(maxsize=1)
+def get_progression_rules() -> ProgressionRules:
+    """Loaded and validated once per process; startup() calls it first."""
+    path = os.environ.get("PROGRESSION_RULES_PATH")
+    raw = json.loads(Path(path).read_text()) if path else DEFAULT_PROGRESSION_RULES
+    return ProgressionRules(raw)
+
+
 def calculate_level(xp: int) -> int:
-    """Calculates level based on XP (100 XP per level)."""
-    return floor(xp / 100) + 1
+    """Calculates level based on XP (xp_per_level XP per level)."""
+    return floor(xp / get_progression_rules().xp_per_level) + 1
 
 
 def get_user_title(level: int) -> str:
-    """Returns a burning 3D title for levels 1-30+"""
-    if level < 5:
-        return "NEON PHANTOM"  # Beginner
-    if level < 10:
-        return "COBALT STRIKER"  # Progressing
-    if level < 15:
-        return "CYBER VANGUARD"  # Intermediate
-    if level < 20:
-        return "PLASMA EXECUTOR"  # Advanced
-    if level < 25:
-        return "TITAN ARCHITECT"  # Elite
-    if level < 30:
-        return "VOID OVERLORD"  # Master
-    return "SOLAR DEITY"  # Level 30+ (Max Rank)
+    """Returns the burning 3D title for the highest tier the level has reached."""
+    rules = get_progression_rules()
+    index = bisect_right(rules.title_levels, level) - 1
+    return rules.title_names[max(index, 0)]
 
 
 def get_badges(xp: int) -> List[str]:
     """Returns a list of badges based on total XP."""
-    badges = []
-    if xp >= 0:
-        badges.append("Beginner")
-    if xp >= 200:
-        badges.append("Novice")
-    if xp >= 1000:
-        badges.append("Intermediate")
-    if xp >= 2500:
-        badges.append("Expert")
-    if xp >= 5000:
-        badges.append("Master")
-    return badges
-
-
-async def apply_shield_protection(user_id: str):
-    user = await db.users.find_one({"id": user_id})
-    if not user or user.get("shields", 0) <= 0:
-        return
-
-    last_completion = await db.habit_completions.find_one(
-        {"user_id": user_id}, sort=[("completed_at", -1)]
-    )
-
-    if not last_completion:
-        return
-
-    now = datetime.now(timezone.utc)
-    today = now.date()
-
-    if isinstance(last_completion["completed_at"], str):
-        last_date = datetime.fromisoformat(last_completion["completed_at"]).date()
-    else:
-        last_date = last_completion["completed_at"].date()
-
-    delta = (today - last_date).days
-
-    if delta == 2:
-        await db.users.update_one({"id": user_id}, {"$inc": {"shields": -1}})
-
-        yesterday_iso = (now - timedelta(days=1)).isoformat()
-
-        await db.habit_completions.insert_one(
-            {
-                "id": str(uuid.uuid4()),
-                "habit_id": "SHIELD_PROTECTION",
-                "user_id": user_id,
-                "completed_at": yesterday_iso,
-                "xp_earned": 0,
-                "type": "shield",
-            }
-        )
-
-        await log_event({**user, "id": user_id}, "SHIELD_USED_AUTOMATICALLY")
+    rules = get_progression_rules()
+    return rules.badge_names[: bisect_right(rules.badge_xp, xp)]
 
 
 async def update_streaks(user_id: str):
@@ -193,11 +361,14 @@ async def update_streaks(user_id: str):
     Restored Full Logic: Calculates current and longest streaks based on unique completion dates.
     This handles consecutive days and gaps correctly.
     """
-    completions = (
-        await db.habit_completions.find({"user_id": user_id})
-        .sort("completed_at", -1)
-        .to_list(1000)
-    )
+    # Completions moved to the archive with their habit still count
+    completions = []
+    for collection in (db.habit_completions, db.habit_completions_archive):
+        completions += (
+            await collection.find({"user_id": user_id}, {"_id": 0, "completed_at": 1})
+            .sort("completed_at", -1)
+            .to_list(1000)
+        )
 
     if not completions:
         return 0, 0
@@ -238,73 +409,1297 @@ async def update_streaks(user_id: str):
                 # Break if the sequence is broken
                 break
 
-    # --- Calculate Longest Streak ---
-    longest = 0
-    temp = 1
-    for i in range(len(unique_dates) - 1):
-        # Check if the next date in the list is exactly 1 day before the current one
-        if (unique_dates[i] - unique_dates[i + 1]).days == 1:
-            temp += 1
-            longest = max(longest, temp)
+    # --- Calculate Longest Streak ---
+    longest = 0
+    temp = 1
+    for i in range(len(unique_dates) - 1):
+        # Check if the next date in the list is exactly 1 day before the current one
+        if (unique_dates[i] - unique_dates[i + 1]).days == 1:
+            temp += 1
+            longest = max(longest, temp)
+        else:
+            temp = 1
+
+    # Ensure longest is at least the current streak
+    longest = max(longest, temp, current_streak)
+
+    return current_streak, longest
+
+
+async def record_progress(habit: dict, value: float):
+    """Appends one measurement to the habit_progress time series."""
+    await db.habit_progress.insert_one(
+        {
+            "ts": datetime.now(timezone.utc),
+            "meta": {"habit_id": habit["id"], "user_id": habit["user_id"]},
+            "value": value,
+        }
+    )
+
+
+def build_log_entry(user, action) -> dict:
+    """Shapes a system_logs row; shared by log_event and the batch jobs."""
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user["id"],
+        "username": user.get("username", user["email"].split("@")[0]),
+        "email": user["email"],
+        "action": action,
+        "role": "ADMIN" if user.get("is_admin") else "USER",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+async def log_event(user, action):
+    """Logs system events to the database for the Admin Panel."""
+    try:
+        await db.system_logs.insert_one(build_log_entry(user, action))
+    except Exception as e:
+        print(f"⚠️ Log Error: {e}")
+
+
+# --- INDEXES & MIGRATIONS ---
+
+
+async def backfill_normalized_fields(batch_size: int = 500) -> int:
+    """
+    Migration: adds lowercased 'email_norm' / 'username_norm' to users created
+    before those fields existed. Safe to re-run; only touches users missing them.
+    """
+    migrated = 0
+    while True:
+        batch = (
+            await db.users.find(
+                {"email_norm": {"$exists": False}},
+                {"_id": 1, "email": 1, "username": 1},
+            )
+            .limit(batch_size)
+            .to_list(batch_size)
+        )
+        if not batch:
+            break
+
+        ops = []
+        for u in batch:
+            fields = {"email_norm": u["email"].lower()}
+            if u.get("username"):
+                fields["username_norm"] = u["username"].lower()
+            ops.append(UpdateOne({"_id": u["_id"]}, {"$set": fields}))
+
+        await db.users.bulk_write(ops, ordered=False)
+        migrated += len(ops)
+
+    print(f"🔧 MIGRATION: normalized {migrated} users", flush=True)
+
+    await resolve_username_collisions()
+
+    collisions = await find_norm_collisions("email_norm")
+    if collisions:
+        for value, ids in collisions:
+            print(f"❌ COLLISION email_norm={value!r}: users {ids}", flush=True)
+        raise RuntimeError(
+            f"{len(collisions)} case-insensitive email collisions; "
+            "merge those accounts (see 'list-email-collisions'), then restart"
+        )
+    return migrated
+
+
+async def find_norm_collisions(field: str) -> list:
+    """
+    Legacy users whose email/username differ only by case. These block the
+    unique indexes. Each entry is (value, ids), ids ordered oldest first.
+    """
+    pipeline = [
+        {"$match": {field: {"$type": "string"}}},
+        {"$sort": {"created_at": 1, "_id": 1}},
+        {"$group": {"_id": f"${field}", "ids": {"$push": "$id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    return [(row["_id"], row["ids"]) async for row in db.users.aggregate(pipeline)]
+
+
+async def resolve_username_collisions() -> int:
+    """
+    Keeps a case-insensitive username on its oldest owner and clears it from
+    the others, who fall back to no username until they pick a new one.
+    """
+    released = 0
+    for value, ids in await find_norm_collisions("username_norm"):
+        result = await db.users.update_many(
+            {"id": {"$in": ids[1:]}},
+            {"$unset": {"username": "", "username_norm": ""}},
+        )
+        released += result.modified_count
+        print(
+            f"🔧 MIGRATION: username {value!r} kept by {ids[0]}, cleared on {ids[1:]}",
+            flush=True,
+        )
+    return released
+
+
+async def list_email_collisions():
+    """CLI: prints the email collisions that block startup."""
+    collisions = await find_norm_collisions("email_norm")
+    for value, ids in collisions:
+        print(f"{value}\t{', '.join(ids)}", flush=True)
+    print(f"{len(collisions)} email collisions", flush=True)
+
+
+async def migrate_legacy_fcm_tokens(batch_size: int = 500) -> int:
+    """Migration: moves the legacy single users.fcm_token into fcm_tokens."""
+    moved = 0
+    while True:
+        batch = (
+            await db.users.find(
+                {"fcm_token": {"$exists": True}}, {"_id": 0, "id": 1, "fcm_token": 1}
+            )
+            .limit(batch_size)
+            .to_list(batch_size)
+        )
+        if not batch:
+            break
+
+        now = datetime.now(timezone.utc).isoformat()
+        ops = [
+            UpdateOne(
+                {"token": u["fcm_token"]},
+                {
+                    "$set": {"user_id": u["id"], "last_seen": now},
+                    "$setOnInsert": new_token_stats(now),
+                },
+                upsert=True,
+            )
+            for u in batch
+            if u.get("fcm_token")
+        ]
+        if ops:
+            await db.fcm_tokens.bulk_write(ops, ordered=False)
+        await db.users.update_many(
+            {"id": {"$in": [u["id"] for u in batch]}}, {"$unset": {"fcm_token": ""}}
+        )
+        moved += len(batch)
+
+    if moved:
+        print(f"🔧 MIGRATION: moved {moved} legacy FCM tokens", flush=True)
+    return moved
+
+
+async def ensure_indexes():
+    """Creates the indexes the app relies on. Idempotent, runs on every startup."""
+    try:
+        # Bucketed storage for measurable-habit history (MongoDB 5.0+)
+        await db.create_collection(
+            "habit_progress",
+            timeseries={"timeField": "ts", "metaField": "meta", "granularity": "hours"},
+        )
+    except CollectionInvalid:
+        pass  # Already exists
+
+    # Hot habit indexes cover active habits only; archived/inactive rows stay out
+    active_only = {"partialFilterExpression": {"is_active": True}}
+
+    specs = [
+        (db.habits, "next_due_at", {"name": "next_due_at_active", **active_only}),
+        # Full, not partial: export, import and user deletion also read
+        # inactive habits by owner. The smaller partial one serves the hot
+        # active-habit lookups.
+        (db.habits, "user_id", {}),
+        (
+            db.habits,
+            [("user_id", 1), ("is_active", 1)],
+            {"name": "user_id_active", **active_only},
+        ),
+        (
+            db.habits,
+            "deactivated_at",
+            {
+                "name": "deactivated_at_inactive",
+                "partialFilterExpression": {"is_active": False},
+            },
+        ),
+        (db.habits_archive, "id", {"unique": True}),
+        (db.habits_archive, "user_id", {}),
+        (db.habit_completions_archive, [("habit_id", 1), ("user_id", 1)], {}),
+        (db.habit_completions_archive, [("user_id", 1), ("completed_at", 1)], {}),
+        (db.fcm_tokens, "token", {"unique": True}),
+        (db.fcm_tokens, "user_id", {}),
+        (db.push_retries, "next_attempt_at", {}),
+        (db.habit_completions, [("user_id", 1), ("completed_at", -1)], {}),
+        # Pending-credit sweep; credited rows drop out of the index
+        (
+            db.habit_completions,
+            "projected",
+            {
+                "name": "projected_pending",
+                "partialFilterExpression": {"projected": False},
+            },
+        ),
+        # REGISTER rows are upserted by id, so replays must not duplicate them
+        (db.system_logs, "id", {"unique": True}),
+        (
+            db.habit_progress,
+            [("meta.habit_id", 1), ("meta.user_id", 1), ("ts", 1)],
+            {},
+        ),
+        (db.users, "email_norm", {"unique": True}),
+        (
+            db.users,
+            "username_norm",
+            {
+                "unique": True,
+                # Users without a username yet must not collide on null
+                "partialFilterExpression": {"username_norm": {"$type": "string"}},
+            },
+        ),
+    ]
+    for collection, keys, options in specs:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            # Register/login rely on unique indexes for correctness: never run
+            # without them. Plain indexes only cost speed, so just warn.
+            if options.get("unique"):
+                raise RuntimeError(
+                    f"Unique index {collection.name}.{keys} could not be built: {e}"
+                )
+            print(f"⚠️ INDEX ERROR ({collection.name}.{keys}): {e}", flush=True)
+
+
+# --- TRANSACTIONS ---
+# Multi-document transactions (and change streams) need a replica set. On a
+# standalone server the same writes run one after another instead.
+
+_replica_set: Optional[bool] = None
+
+
+async def has_replica_set() -> bool:
+    global _replica_set
+    if _replica_set is None:
+        hello = await client.admin.command("hello")
+        _replica_set = bool(hello.get("setName"))
+    return _replica_set
+
+
+@asynccontextmanager
+async def write_session():
+    """
+    Yields a session inside a transaction on a replica set, or None on a
+    standalone server (writes accept session=None and apply individually).
+    """
+    if not await has_replica_set():
+        yield None
+        return
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            yield session
+
+
+# --- PROJECTIONS (CHANGE STREAMS) ---
+# Derived user state (XP, level, badges, streaks, active habit count, REGISTER
+# audit rows) is maintained here from MongoDB change streams instead of inline
+# in request handlers. Every handler below is idempotent, so replaying an event
+# after a restart is harmless. Change streams need a replica set; the worker
+# refuses to start without one.
+
+PROJECTION_RETRY_SECONDS = 5
+# A failing event is retried this often, then parked in projection_dead_letters
+PROJECTION_MAX_ATTEMPTS = 5
+# Resume token no longer in the oplog: ChangeStreamHistoryLost / ChangeStreamFatalError
+RESUME_TOKEN_LOST_CODES = {280, 286}
+# Only one process tails the streams; it renews this lease while it does
+PROJECTION_LEASE = timedelta(seconds=30)
+PROJECTION_WORKER_ID = str(uuid.uuid4())
+
+
+async def apply_completion(completion: dict):
+    """
+    Credits a pending completion (projected=False) to its user exactly once:
+    the claim and the user update commit together in one transaction.
+    """
+    uid = completion["user_id"]
+    async with write_session() as session:
+        claimed = await db.habit_completions.update_one(
+            {"_id": completion["_id"], "projected": False},
+            {"$set": {"projected": True}},
+            session=session,
+        )
+        if not claimed.modified_count:
+            return
+
+        cur, lon = await update_streaks(uid)
+        await db.users.update_one(
+            {"id": uid},
+            {
+                "$inc": {"xp": completion.get("xp_earned", 0)},
+                "$set": {
+                    "current_streak": cur,
+                    "last_active": completion["completed_at"],
+                },
+                "$max": {"longest_streak": lon},
+            },
+            session=session,
+        )
+
+
+async def sync_progression(uid: str):
+    """Brings level/badges in line with the user's XP, writing only on change."""
+    user = await db.users.find_one(
+        {"id": uid}, {"_id": 0, "xp": 1, "level": 1, "badges": 1}
+    )
+    if not user:
+        return
+    xp = user.get("xp", 0)
+    fields = {"level": calculate_level(xp), "badges": get_badges(xp)}
+    if any(user.get(k) != v for k, v in fields.items()):
+        await db.users.update_one({"id": uid}, {"$set": fields})
+
+
+async def sync_active_habits(uid: str):
+    count = await db.habits.count_documents({"user_id": uid, "is_active": True})
+    await db.users.update_one({"id": uid}, {"$set": {"active_habits": count}})
+
+
+async def project_completion_event(event: dict):
+    # Only completions from complete_habit are pending; imports and shield
+    # completions are written without the flag and settle their own state
+    if event["fullDocument"].get("projected") is False:
+        await apply_completion(event["fullDocument"])
+
+
+async def project_habit_event(event: dict):
+    # Delete events are excluded by the stream's $match: they carry no
+    # fullDocument, so there would be no user_id to recount for
+    habit = event.get("fullDocument")
+    if habit:
+        await sync_active_habits(habit["user_id"])
+
+
+async def project_user_event(event: dict):
+    user = event.get("fullDocument")
+    if not user:
+        return
+
+    if event["operationType"] == "insert":
+        # Deterministic id makes the REGISTER row idempotent on replay
+        entry = build_log_entry(user, "REGISTER")
+        entry["id"] = f"register-{user['id']}"
+        await db.system_logs.update_one(
+            {"id": entry["id"]}, {"$setOnInsert": entry}, upsert=True
+        )
+        return
+
+    # Our own level/badges writes don't touch xp, so this can't loop
+    updated = event.get("updateDescription", {}).get("updatedFields", {})
+    if "xp" in updated:
+        await sync_progression(user["id"])
+
+
+def _inserts_or_updates_of(field: str) -> dict:
+    """$match for inserts plus updates that set 'field'; other writes are ignored."""
+    return {
+        "$or": [
+            {"operationType": "insert"},
+            {
+                "operationType": "update",
+                f"updateDescription.updatedFields.{field}": {"$exists": True},
+            },
+        ]
+    }
+
+
+# collection -> ($match on the change stream, handler)
+PROJECTIONS = {
+    "habit_completions": ({"operationType": "insert"}, project_completion_event),
+    "habits": (_inserts_or_updates_of("is_active"), project_habit_event),
+    "users": (_inserts_or_updates_of("xp"), project_user_event),
+}
+
+
+async def handle_projection_event(name: str, handler, event: dict):
+    """
+    Runs a handler with bounded retries. An event that keeps failing is stored
+    as a dead letter so the stream can move past it instead of stalling.
+    """
+    for attempt in range(1, PROJECTION_MAX_ATTEMPTS + 1):
+        try:
+            await handler(event)
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if attempt == PROJECTION_MAX_ATTEMPTS:
+                await db.projection_dead_letters.insert_one(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "projection": name,
+                        "operation": event.get("operationType"),
+                        "document_key": event.get("documentKey"),
+                        "event": event,
+                        "error": repr(e)[:500],
+                        "failed_at": datetime.now(timezone.utc).isoformat(),
+                    }
+                )
+                print(f"☠️ PROJECTION {name}: dead-lettered event ({e})", flush=True)
+                return
+            await asyncio.sleep(attempt)
+
+
+async def credit_pending_completions() -> int:
+    """Credits every completion still flagged projected=False."""
+    credited = 0
+    async for completion in db.habit_completions.find({"projected": False}):
+        await apply_completion(completion)
+        credited += 1
+    return credited
+
+
+async def run_projection(name: str):
+    """Tails one collection forever, resuming from the last stored token."""
+    match, handler = PROJECTIONS[name]
+    pipeline = [{"$match": match}]
+    sweep_pending = False
+
+    while True:
+        try:
+            state = await db.projection_state.find_one({"_id": name}) or {}
+            async with db[name].watch(
+                pipeline,
+                full_document="updateLookup",
+                resume_after=state.get("resume_token"),
+            ) as stream:
+                print(f"👁️ PROJECTION {name}: watching", flush=True)
+
+                # Events missed while the token was lost: completions are
+                # caught up here, once the new stream is already open so
+                # nothing falls between the sweep and the stream
+                if sweep_pending:
+                    credited = await credit_pending_completions()
+                    print(f"🔁 PROJECTION {name}: credited {credited}", flush=True)
+                    sweep_pending = False
+
+                async for event in stream:
+                    await handle_projection_event(name, handler, event)
+                    await db.projection_state.update_one(
+                        {"_id": name},
+                        {
+                            "$set": {
+                                "resume_token": stream.resume_token,
+                                "updated_at": datetime.now(timezone.utc).isoformat(),
+                            }
+                        },
+                        upsert=True,
+                    )
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code in RESUME_TOKEN_LOST_CODES:
+                # Fell off the oplog: start fresh from now
+                await db.projection_state.delete_one({"_id": name})
+                if name == "habit_completions":
+                    sweep_pending = True
+                else:
+                    print(
+                        f"⚠️ PROJECTION {name}: resume token lost, run a replay",
+                        flush=True,
+                    )
+            else:
+                print(f"⚠️ PROJECTION {name} ERROR: {e}", flush=True)
+            await asyncio.sleep(PROJECTION_RETRY_SECONDS)
+        except Exception as e:
+            print(f"⚠️ PROJECTION {name} ERROR: {e}", flush=True)
+            await asyncio.sleep(PROJECTION_RETRY_SECONDS)
+
+
+async def require_replica_set():
+    """Change streams don't exist on a standalone server; refuse to run without."""
+    if not await has_replica_set():
+        raise RuntimeError(
+            "Projections need MongoDB running as a replica set "
+            "(start mongod with --replSet and run rs.initiate() once)"
+        )
+
+
+async def hold_projection_lease() -> bool:
+    """Claims or renews the worker lease; False while another process holds it."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_locks.update_one(
+            {
+                "_id": "projection_worker",
+                "$or": [
+                    {"owner": PROJECTION_WORKER_ID},
+                    {"expires_at": {"$lt": now.isoformat()}},
+                ],
+            },
+            {
+                "$set": {
+                    "owner": PROJECTION_WORKER_ID,
+                    "expires_at": (now + PROJECTION_LEASE).isoformat(),
+                }
+            },
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def run_projections():
+    """
+    Projection worker: all streams side by side. Every API process starts one,
+    but only the holder of the lease tails the streams; the others stand by
+    and take over if it stops renewing.
+    """
+    await require_replica_set()
+    renew_every = PROJECTION_LEASE.total_seconds() / 3
+
+    while True:
+        try:
+            if await hold_projection_lease():
+                print(
+                    f"👑 PROJECTIONS: worker {PROJECTION_WORKER_ID} leading", flush=True
+                )
+                streams = asyncio.gather(*(run_projection(n) for n in PROJECTIONS))
+                try:
+                    while await hold_projection_lease():
+                        await asyncio.sleep(renew_every)
+                finally:
+                    streams.cancel()
+                    await asyncio.gather(streams, return_exceptions=True)
+                print("✋ PROJECTIONS: lease lost, standing by", flush=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ PROJECTIONS LEASE ERROR: {e}", flush=True)
+        await asyncio.sleep(renew_every)
+
+
+async def replay_projections(batch_size: int = 500) -> int:
+    """
+    Rebuilds every projection from source data: credits pending completions,
+    then recomputes streaks, level, badges and active habit counts for all users.
+    Resume tokens are dropped first so workers restart from the present.
+    """
+    await db.projection_state.delete_many({})
+    await credit_pending_completions()
+
+    active_counts = {
+        row["_id"]: row["count"]
+        async for row in db.habits.aggregate(
+            [
+                {"$match": {"is_active": True}},
+                {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+            ]
+        )
+    }
+
+    rebuilt = 0
+    ops = []
+    cursor = db.users.find(
+        {},
+        {
+            "_id": 1,
+            "id": 1,
+            "xp": 1,
+            "level": 1,
+            "badges": 1,
+            "current_streak": 1,
+            "longest_streak": 1,
+            "active_habits": 1,
+        },
+    )
+    async for u in cursor.batch_size(batch_size):
+        xp = u.get("xp", 0)
+        cur, lon = await update_streaks(u["id"])
+        fields = {
+            "level": calculate_level(xp),
+            "badges": get_badges(xp),
+            "current_streak": cur,
+            "longest_streak": max(lon, u.get("longest_streak", 0)),
+            "active_habits": active_counts.get(u["id"], 0),
+        }
+        if any(u.get(k) != v for k, v in fields.items()):
+            ops.append(UpdateOne({"_id": u["_id"]}, {"$set": fields}))
+
+        if len(ops) >= batch_size:
+            await db.users.bulk_write(ops, ordered=False)
+            rebuilt += len(ops)
+            ops = []
+
+    if ops:
+        await db.users.bulk_write(ops, ordered=False)
+        rebuilt += len(ops)
+
+    print(f"🔁 REPLAY: rebuilt projections for {rebuilt} users", flush=True)
+    return rebuilt
+
+
+# --- PROGRESSION RECOMPUTE JOB ---
+
+RECOMPUTE_BATCH_SIZE = 1000
+
+
+async def recompute_progression(force: bool = True) -> int:
+    """
+    Streams every user and rewrites level/badges only where the current rules
+    disagree with what is stored. Runs under a job lock keyed by the rules
+    version: one worker applies a version bump, and the startup run is a no-op
+    once that version is done. 'force' re-applies an already applied version.
+    """
+    rules = get_progression_rules()
+    key = str(rules.version)
+    if not await acquire_job_lock("progression_recompute", key, rerun=force):
+        return 0
+
+    changed = 0
+    ops = []
+    cursor = db.users.find({}, {"_id": 1, "xp": 1, "level": 1, "badges": 1})
+    async for u in cursor.batch_size(RECOMPUTE_BATCH_SIZE):
+        xp = u.get("xp", 0)
+        fields = {"level": calculate_level(xp), "badges": get_badges(xp)}
+        if any(u.get(k) != v for k, v in fields.items()):
+            # Guard on the XP we computed from: if it moved meanwhile, the
+            # users projection has already derived level/badges from the new value
+            ops.append(
+                UpdateOne({"_id": u["_id"], "xp": u.get("xp")}, {"$set": fields})
+            )
+
+        if len(ops) >= RECOMPUTE_BATCH_SIZE:
+            await db.users.bulk_write(ops, ordered=False)
+            changed += len(ops)
+            ops = []
+
+    if ops:
+        await db.users.bulk_write(ops, ordered=False)
+        changed += len(ops)
+
+    await finish_job_lock("progression_recompute", key, {"users_updated": changed})
+    print(f"📈 PROGRESSION v{rules.version}: {changed} users updated", flush=True)
+    return changed
+
+
+# --- JOB LOCKS ---
+# One document per batch job in job_locks. A run is identified by a key (the
+# day, a rules version...) and is only marked done once all its work landed.
+
+JOB_LOCK_STALE = timedelta(hours=1)
+
+
+async def acquire_job_lock(name: str, key: str, rerun: bool = False) -> bool:
+    """
+    Claims run 'key' of job 'name'. Fails if that run is already done (unless
+    'rerun') or was started recently by another worker; a run stuck in
+    'started' for longer than JOB_LOCK_STALE is assumed crashed and taken over.
+    """
+    now = datetime.now(timezone.utc)
+    stale = (now - JOB_LOCK_STALE).isoformat()
+    claimable = [
+        {"key": {"$ne": key}},
+        {"status": "started", "started_at": {"$lt": stale}},
+    ]
+    if rerun:
+        claimable.append({"status": "done"})
+    try:
+        await db.job_locks.update_one(
+            {"_id": name, "$or": claimable},
+            {"$set": {"key": key, "status": "started", "started_at": now.isoformat()}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def finish_job_lock(name: str, key: str, result: Optional[dict] = None):
+    await db.job_locks.update_one(
+        {"_id": name, "key": key},
+        {
+            "$set": {
+                "status": "done",
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "result": result,
+            }
+        },
+    )
+
+
+# --- DAY ROLLOVER JOB ---
+
+ROLLOVER_BATCH_SIZE = 500
+
+
+async def run_day_rollover():
+    """
+    Nightly pass over users with a live streak who missed yesterday:
+    - last completion was the day before yesterday and a shield is available
+      -> consume it and backfill yesterday with a shield completion
+    - otherwise -> reset current_streak to 0
+    Scheduled hourly and run once at startup, but only the first run of each
+    UTC day does any work (job lock). A run that crashed stays 'started' and is
+    taken over by the first attempt after JOB_LOCK_STALE. Re-running is safe:
+    shielded users now have a completion for yesterday and reset users have no
+    streak, so both drop out.
+    """
+    now = datetime.now(timezone.utc)
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    yesterday_start = today_start - timedelta(days=1)
+    day_before_start = today_start - timedelta(days=2)
+    today_str = today_start.date().isoformat()
+
+    if not await acquire_job_lock("day_rollover", today_str):
+        print(f"✋ ROLLOVER SKIPPED: {today_str} already handled", flush=True)
+        return
+
+    pipeline = [
+        {"$match": {"current_streak": {"$gt": 0}}},
+        {
+            "$lookup": {
+                "from": "habit_completions",
+                "let": {"uid": "$id"},
+                "pipeline": [
+                    {
+                        "$match": {
+                            "$expr": {
+                                "$and": [
+                                    {"$eq": ["$user_id", "$$uid"]},
+                                    {
+                                        "$gte": [
+                                            "$completed_at",
+                                            day_before_start.isoformat(),
+                                        ]
+                                    },
+                                ]
+                            }
+                        }
+                    },
+                    {"$project": {"_id": 0, "completed_at": 1}},
+                ],
+                "as": "recent",
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "id": 1,
+                "email": 1,
+                "username": 1,
+                "is_admin": 1,
+                "shields": 1,
+                "last": {"$max": "$recent.completed_at"},
+            }
+        },
+        # No completion since yesterday started -> yesterday was missed
+        {
+            "$match": {
+                "$or": [
+                    {"last": None},
+                    {"last": {"$lt": yesterday_start.isoformat()}},
+                ]
+            }
+        },
+    ]
+
+    shield_day_iso = (now - timedelta(days=1)).isoformat()
+    totals = {"shielded": 0, "reset": 0}
+    reset_ops, logs = [], []
+
+    async def flush():
+        if reset_ops:
+            await db.users.bulk_write(reset_ops, ordered=False)
+        if logs:
+            await db.system_logs.insert_many(logs, ordered=False)
+        reset_ops.clear()
+        logs.clear()
+
+    async def use_shield(user: dict) -> bool:
+        """
+        Spends one shield and backfills yesterday in a single transaction, so a
+        shield is never consumed without its completion (or vice versa). On a
+        standalone server the two writes are sequential.
+        """
+        async with write_session() as session:
+            spent = await db.users.update_one(
+                {"id": user["id"], "shields": {"$gt": 0}},
+                [
+                    {
+                        "$set": {
+                            "shields": {"$subtract": ["$shields", 1]},
+                            "current_streak": {"$add": ["$current_streak", 1]},
+                        }
+                    },
+                    {
+                        "$set": {
+                            "longest_streak": {
+                                "$max": ["$longest_streak", "$current_streak"]
+                            }
+                        }
+                    },
+                ],
+                session=session,
+            )
+            # Shield already spent elsewhere: nothing to backfill
+            if not spent.modified_count:
+                return False
+
+            await db.habit_completions.insert_one(
+                {
+                    "id": str(uuid.uuid4()),
+                    "habit_id": "SHIELD_PROTECTION",
+                    "user_id": user["id"],
+                    "completed_at": shield_day_iso,
+                    "xp_earned": 0,
+                    "type": "shield",
+                },
+                session=session,
+            )
+            return True
+
+    async for user in db.users.aggregate(pipeline):
+        # Shield covers yesterday, so the streak carries on through it
+        if user.get("last") and user.get("shields", 0) > 0 and await use_shield(user):
+            logs.append(build_log_entry(user, "SHIELD_USED_AUTOMATICALLY"))
+            totals["shielded"] += 1
+        else:
+            reset_ops.append(
+                UpdateOne({"id": user["id"]}, {"$set": {"current_streak": 0}})
+            )
+            totals["reset"] += 1
+
+        if len(reset_ops) >= ROLLOVER_BATCH_SIZE or len(logs) >= ROLLOVER_BATCH_SIZE:
+            await flush()
+
+    await flush()
+    await finish_job_lock("day_rollover", today_str)
+    print(
+        f"🌙 ROLLOVER {today_str}: {totals['shielded']} shielded, "
+        f"{totals['reset']} streaks reset",
+        flush=True,
+    )
+    return totals
+
+
+# --- REMINDER SCHEDULING ---
+# Each active habit with a notification_time carries a precomputed UTC
+# 'next_due_at', derived from its recurrence and the owner's time zone.
+# The scheduler only ever asks "what is due now?" against that index.
+
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "Asia/Kolkata")
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+ALL_DAYS = list(range(7))
+# Reminders more than this late (e.g. after downtime) are skipped, not sent
+REMINDER_GRACE = timedelta(minutes=10)
+
+
+def get_zone(name: Optional[str]) -> ZoneInfo:
+    """Resolves an IANA zone name, falling back to the default zone."""
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def parse_recurrence(frequency: Optional[str], anchor: datetime) -> List[int]:
+    """
+    Turns a frequency into weekday numbers (Mon=0):
+    'daily' -> every day, 'weekly' -> the anchor's weekday, 'Mon,Wed' -> those days.
+    """
+    if not frequency or frequency == "daily":
+        return ALL_DAYS
+    if frequency == "weekly":
+        return [anchor.weekday()]
+    days = sorted(
+        {
+            WEEKDAYS.index(d.strip())
+            for d in frequency.split(",")
+            if d.strip() in WEEKDAYS
+        }
+    )
+    return days or ALL_DAYS
+
+
+def compute_next_due(
+    notification_time: Optional[str], days: List[int], tz: ZoneInfo, after: datetime
+) -> Optional[datetime]:
+    """First occurrence of the local reminder time strictly after 'after', in UTC."""
+    if not notification_time or not re.match(r"^\d{2}:\d{2}$", notification_time):
+        return None
+    hour, minute = map(int, notification_time.split(":"))
+    if hour > 23 or minute > 59:
+        return None
+
+    local_today = after.astimezone(tz).date()
+    for offset in range(8):
+        day = local_today + timedelta(days=offset)
+        if day.weekday() not in days:
+            continue
+        # zoneinfo resolves DST gaps/overlaps when converting to UTC
+        candidate = datetime.combine(day, dt_time(hour, minute), tzinfo=tz)
+        candidate = candidate.astimezone(timezone.utc)
+        if candidate > after:
+            return candidate
+    return None
+
+
+def schedule_fields(habit: dict, tz_name: Optional[str]) -> dict:
+    """recurrence_days / timezone / next_due_at for a habit document."""
+    tz = get_zone(tz_name)
+    created = habit.get("created_at")
+    anchor = (
+        datetime.fromisoformat(created) if created else datetime.now(timezone.utc)
+    ).astimezone(tz)
+    days = parse_recurrence(habit.get("frequency"), anchor)
+    return {
+        "recurrence_days": days,
+        "timezone": tz.key,
+        "next_due_at": compute_next_due(
+            habit.get("notification_time"), days, tz, datetime.now(timezone.utc)
+        ),
+    }
+
+
+async def reschedule_habit(habit: dict, tz_name: Optional[str]):
+    await db.habits.update_one(
+        {"id": habit["id"]}, {"$set": schedule_fields(habit, tz_name)}
+    )
+
+
+async def backfill_habit_schedules(batch_size: int = 500) -> int:
+    """Migration: computes next_due_at for habits created before it existed."""
+    scheduled = 0
+    while True:
+        batch = (
+            await db.habits.find(
+                {"recurrence_days": {"$exists": False}},
+                {
+                    "_id": 1,
+                    "user_id": 1,
+                    "frequency": 1,
+                    "notification_time": 1,
+                    "created_at": 1,
+                },
+            )
+            .limit(batch_size)
+            .to_list(batch_size)
+        )
+        if not batch:
+            break
+
+        owners = await db.users.find(
+            {"id": {"$in": list({h["user_id"] for h in batch})}},
+            {"_id": 0, "id": 1, "timezone": 1},
+        ).to_list(batch_size)
+        zones = {u["id"]: u.get("timezone") for u in owners}
+
+        await db.habits.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": h["_id"]},
+                    {"$set": schedule_fields(h, zones.get(h["user_id"]))},
+                )
+                for h in batch
+            ],
+            ordered=False,
+        )
+        scheduled += len(batch)
+
+    if scheduled:
+        print(f"🔧 MIGRATION: scheduled {scheduled} habits", flush=True)
+    return scheduled
+
+
+# --- PUSH DELIVERY ---
+
+# Token is dead for good -> delete it so it is never tried again
+FCM_PRUNE_ERRORS = (
+    messaging.UnregisteredError,
+    messaging.SenderIdMismatchError,
+    firebase_exceptions.InvalidArgumentError,
+)
+# Worth another attempt later -> push onto the retry queue
+FCM_TRANSIENT_ERRORS = (
+    firebase_exceptions.UnavailableError,
+    firebase_exceptions.InternalError,
+    firebase_exceptions.DeadlineExceededError,
+    firebase_exceptions.ResourceExhaustedError,
+)
+
+PUSH_RETRY_BASE_SECONDS = 30
+PUSH_RETRY_MAX_SECONDS = 3600
+PUSH_RETRY_MAX_ATTEMPTS = 6
+PUSH_RETRY_BATCH_SIZE = 100
+
+
+def new_token_stats(now_iso: str) -> dict:
+    """Initial per-token delivery counters."""
+    return {
+        "created_at": now_iso,
+        "sent_count": 0,
+        "failure_count": 0,
+        "last_success_at": None,
+        "last_failure_at": None,
+        "last_error": None,
+    }
+
+
+def push_backoff(attempts: int) -> timedelta:
+    """Exponential backoff with a little jitter so retries don't arrive in lockstep."""
+    delay = min(PUSH_RETRY_BASE_SECONDS * 2 ** (attempts - 1), PUSH_RETRY_MAX_SECONDS)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+async def deliver_push(token: str, payload: dict) -> str:
+    """
+    Sends one push and books the outcome against the token.
+    Returns 'sent', 'pruned', 'retry' or 'failed'.
+    """
+    msg = messaging.Message(
+        notification=messaging.Notification(
+            title=payload["title"], body=payload["body"]
+        ),
+        data=payload["data"],
+        token=token,
+    )
+    now = datetime.now(timezone.utc).isoformat()
+
+    try:
+        # messaging.send is blocking HTTP; keep it off the event loop
+        await run_in_threadpool(messaging.send, msg)
+    except FCM_PRUNE_ERRORS as e:
+        await db.fcm_tokens.delete_one({"token": token})
+        print(f"🗑️ PRUNED DEAD TOKEN: ...{token[-8:]} ({e})", flush=True)
+        return "pruned"
+    except Exception as e:
+        await db.fcm_tokens.update_one(
+            {"token": token},
+            {
+                "$inc": {"failure_count": 1},
+                "$set": {"last_failure_at": now, "last_error": str(e)[:200]},
+            },
+        )
+        print(f"❌ FIREBASE SEND FAILED: {e}", flush=True)
+        return "retry" if isinstance(e, FCM_TRANSIENT_ERRORS) else "failed"
+
+    await db.fcm_tokens.update_one(
+        {"token": token},
+        {"$inc": {"sent_count": 1}, "$set": {"last_success_at": now}},
+    )
+    return "sent"
+
+
+async def send_push_to_user(
+    user_id: str, payload: dict, expires_at: Optional[datetime] = None
+) -> int:
+    """
+    Fans a push out to every device of the user. Returns how many were sent.
+    Transient failures are retried until 'expires_at', if given.
+    """
+    tokens = await db.fcm_tokens.find(
+        {"user_id": user_id}, {"_id": 0, "token": 1}
+    ).to_list(100)
+    if not tokens:
+        return 0
+
+    results = await asyncio.gather(*(deliver_push(t["token"], payload) for t in tokens))
+
+    next_attempt_at = datetime.now(timezone.utc) + push_backoff(1)
+    if expires_at and next_attempt_at > expires_at:
+        return results.count("sent")  # Would only arrive stale
+
+    retries = [
+        {
+            "id": str(uuid.uuid4()),
+            "token": t["token"],
+            "user_id": user_id,
+            "payload": payload,
+            "attempts": 1,
+            "next_attempt_at": next_attempt_at,
+            "expires_at": expires_at,
+        }
+        for t, result in zip(tokens, results)
+        if result == "retry"
+    ]
+    if retries:
+        await db.push_retries.insert_many(retries)
+
+    return results.count("sent")
+
+
+async def process_push_retries():
+    """Drains due entries from the persistent retry queue."""
+    # Past their deadline (e.g. a reminder beyond its grace window): drop
+    await db.push_retries.delete_many(
+        {"expires_at": {"$lt": datetime.now(timezone.utc)}}
+    )
+
+    for _ in range(PUSH_RETRY_BATCH_SIZE):
+        now = datetime.now(timezone.utc)
+
+        # Claim one due entry by pushing it into the future (lease), so other
+        # workers skip it while we send
+        entry = await db.push_retries.find_one_and_update(
+            {
+                "next_attempt_at": {"$lte": now},
+                "$or": [{"expires_at": None}, {"expires_at": {"$gt": now}}],
+            },
+            {"$set": {"next_attempt_at": now + timedelta(minutes=5)}},
+            sort=[("next_attempt_at", 1)],
+        )
+        if not entry:
+            return
+
+        result = await deliver_push(entry["token"], entry["payload"])
+
+        attempts = entry["attempts"] + 1
+        next_attempt_at = now + push_backoff(attempts)
+        expires_at = entry.get("expires_at")
+        if expires_at and next_attempt_at > expires_at.replace(tzinfo=timezone.utc):
+            result = "expired"
+
+        if result == "retry" and entry["attempts"] < PUSH_RETRY_MAX_ATTEMPTS:
+            await db.push_retries.update_one(
+                {"_id": entry["_id"]},
+                {"$set": {"attempts": attempts, "next_attempt_at": next_attempt_at}},
+            )
         else:
-            temp = 1
+            await db.push_retries.delete_one({"_id": entry["_id"]})
 
-    # Ensure longest is at least the current streak
-    longest = max(longest, temp, current_streak)
 
-    return current_streak, longest
+# --- ARCHIVAL JOB ---
+# Habits soft-deleted more than ARCHIVE_AFTER_DAYS ago, together with their
+# completions older than that, move to *_archive collections so the hot
+# collections (and their indexes) only hold what the app actually queries.
 
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = 500
 
-async def log_event(user, action):
-    """Logs system events to the database for the Admin Panel."""
+
+async def copy_documents(target, docs: list):
+    """insert_many that tolerates only duplicate-key errors (already copied)."""
     try:
-        await db.system_logs.insert_one(
-            {
-                "id": str(uuid.uuid4()),
-                "user_id": user["id"],
-                "username": user.get("username", user["email"].split("@")[0]),
-                "email": user["email"],
-                "action": action,
-                "role": "ADMIN" if user.get("is_admin") else "USER",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-            }
+        await target.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+
+
+async def move_documents(source, target, query: dict, batch_size: int) -> int:
+    """
+    Copies matching documents to 'target' then deletes them from 'source', in
+    batches. _id is kept, so a rerun after a crash just skips the copies.
+    """
+    moved = 0
+    while True:
+        batch = await source.find(query).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return moved
+        await copy_documents(target, batch)
+        await source.delete_many({"_id": {"$in": [d["_id"] for d in batch]}})
+        moved += len(batch)
+
+
+async def compact_inactive_habits(batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+    """
+    Moves long-inactive habits and their old completions into the archive.
+    Runs once per UTC day under a job lock, so API processes don't overlap.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    totals = {"habits": 0, "completions": 0}
+    today_str = now.date().isoformat()
+
+    if not await acquire_job_lock("habit_compaction", today_str):
+        print(f"✋ ARCHIVE SKIPPED: {today_str} already handled", flush=True)
+        return totals
+
+    while True:
+        habits = (
+            await db.habits.find(
+                {
+                    "is_active": False,
+                    # Legacy soft-deletes have no timestamp: treat them as old
+                    "$or": [
+                        {"deactivated_at": {"$lt": cutoff}},
+                        {"deactivated_at": {"$exists": False}},
+                    ],
+                }
+            )
+            .limit(batch_size)
+            .to_list(batch_size)
         )
-    except Exception as e:
-        print(f"⚠️ Log Error: {e}")
+        if not habits:
+            break
+
+        ids = [h["id"] for h in habits]
+        totals["completions"] += await move_documents(
+            db.habit_completions,
+            db.habit_completions_archive,
+            {"habit_id": {"$in": ids}, "completed_at": {"$lt": cutoff}},
+            batch_size,
+        )
+
+        for h in habits:
+            h["archived_at"] = now.isoformat()
+        await copy_documents(db.habits_archive, habits)
+        removed = await db.habits.delete_many(
+            {"_id": {"$in": [h["_id"] for h in habits]}, "is_active": False}
+        )
+        totals["habits"] += removed.deleted_count
+
+        # Restored while we were moving it: the live copy wins, so undo the
+        # archive copy and bring its completions back
+        if removed.deleted_count < len(habits):
+            restored = await db.habits.distinct("id", {"id": {"$in": ids}})
+            await db.habits_archive.delete_many({"id": {"$in": restored}})
+            totals["completions"] -= await move_documents(
+                db.habit_completions_archive,
+                db.habit_completions,
+                {"habit_id": {"$in": restored}},
+                batch_size,
+            )
+
+    print(
+        f"📦 ARCHIVE: {totals['habits']} habits, "
+        f"{totals['completions']} completions moved",
+        flush=True,
+    )
+    await finish_job_lock("habit_compaction", today_str, totals)
+    return totals
 
 
 # --- NOTIFICATION ENGINE (Full Robust Version) ---
 async def check_and_send_notifications():
     """
-    Checks for habits due at the current IST time and sends FCM notifications.
-    Uses 'last_notified_date' to prevent double-sending.
+    Sends FCM reminders for every habit whose precomputed 'next_due_at' has
+    passed, then advances it to the next occurrence in the owner's time zone.
+    Advancing 'next_due_at' is the atomic lock that prevents double-sending.
     """
-    # 1. UTC to IST Conversion
-    now_utc = datetime.now(timezone.utc)
-    now_ist = now_utc + timedelta(hours=5, minutes=30)
-    current_time_str = now_ist.strftime("%H:%M")
-    current_seconds = now_ist.strftime("%S")
-    today_str = now_ist.strftime("%Y-%m-%d")
+    now = datetime.now(timezone.utc)
 
     # Debug Log for Terminal Visibility
-    print(f"⏰ TICK: {current_time_str}:{current_seconds} | Scanning...", flush=True)
+    print(f"⏰ TICK: {now.strftime('%H:%M:%S')} UTC | Scanning...", flush=True)
 
-    # 2. Find habits due NOW that haven't been notified TODAY yet
-    cursor = db.habits.find(
-        {
-            "notification_time": current_time_str,
-            "is_active": True,
-            "last_notified_date": {"$ne": today_str},  # CRITICAL: Ensures 1 per day
-        }
-    )
+    # 1. One indexed range query: only habits that are actually due
+    cursor = db.habits.find({"next_due_at": {"$lte": now}, "is_active": True})
 
     async for habit in cursor:
-        print(f"🎯 MATCH FOUND: {habit['name']}", flush=True)
+        due_at = habit["next_due_at"].replace(tzinfo=timezone.utc)
+        tz = get_zone(habit.get("timezone"))
+        next_due = compute_next_due(
+            habit.get("notification_time"),
+            habit.get("recurrence_days", ALL_DAYS),
+            tz,
+            now,
+        )
 
-        # 3. Update DB first (Atomic Lock)
+        # 2. Advance first (Atomic Lock): only the worker that moves it sends
         update_result = await db.habits.update_one(
-            {"id": habit["id"], "last_notified_date": {"$ne": today_str}},
-            {"$set": {"last_notified_date": today_str}},
+            {"id": habit["id"], "next_due_at": habit["next_due_at"]},
+            {
+                "$set": {
+                    "next_due_at": next_due,
+                    "last_notified_date": due_at.astimezone(tz).date().isoformat(),
+                }
+            },
         )
 
         # If update failed (modified_count=0), another worker handled it
@@ -312,31 +1707,32 @@ async def check_and_send_notifications():
             print(f"✋ SKIPPED: {habit['name']} (Already Handled)", flush=True)
             continue
 
-        # 4. Fetch User for Token
-        user = await db.users.find_one({"id": habit["user_id"]})
+        if now - due_at > REMINDER_GRACE:
+            print(f"⌛ STALE: {habit['name']} was due {due_at}, not sent", flush=True)
+            continue
 
-        if user and user.get("fcm_token"):
-            try:
-                # 5. Send Notification with Data Payload
-                msg = messaging.Message(
-                    notification=messaging.Notification(
-                        title=f"MISSION START: {habit['name']}",
-                        body="Time to execute your daily quest.",
-                    ),
-                    data={
-                        "type": "reminder",
-                        "habit_id": habit["id"],
-                        "click_action": "FLUTTER_NOTIFICATION_CLICK",
-                    },
-                    token=user["fcm_token"],
-                )
+        print(f"🎯 DUE: {habit['name']}", flush=True)
+
+        # 3. Send to every registered device of the user
+        sent = await send_push_to_user(
+            habit["user_id"],
+            {
+                "title": f"MISSION START: {habit['name']}",
+                "body": "Time to execute your daily quest.",
+                "data": {
+                    "type": "reminder",
+                    "habit_id": habit["id"],
+                    "click_action": "FLUTTER_NOTIFICATION_CLICK",
+                },
+            },
+            # Same grace as above: retries must not deliver a stale reminder
+            expires_at=due_at + REMINDER_GRACE,
+        )
 
-                response = messaging.send(msg)
-                print(f"🚀 SENT SUCCESSFULLY TO: {user['email']}", flush=True)
-            except Exception as e:
-                print(f"❌ FIREBASE SEND FAILED: {e}", flush=True)
+        if sent:
+            print(f"🚀 SENT TO {sent} DEVICE(S): {habit['user_id']}", flush=True)
         else:
-            print(f"⚠️ NO TOKEN: User {user.get('email', 'Unknown')}", flush=True)
+            print(f"⚠️ NOT DELIVERED: User {habit['user_id']}", flush=True)
 
 
 # --- PYDANTIC MODELS (Full Definitions) ---
@@ -344,6 +1740,7 @@ class UserRegister(BaseModel):
     email: EmailStr
     password: str
     phone: Optional[str] = None
+    timezone: Optional[str] = None
 
 
 class UserLogin(BaseModel):
@@ -378,6 +1775,7 @@ class User(BaseModel):
     created_at: str
     last_active: Optional[str] = None
     fcm_token: Optional[str] = None
+    timezone: Optional[str] = None
 
 
 class Habit(BaseModel):
@@ -386,9 +1784,9 @@ class Habit(BaseModel):
     user_id: str
     name: str
     is_measurable: bool = False
-    starting_point: float = 0 
+    starting_point: float = 0
     target_value: float = 0
-    current_value: float = 0 
+    current_value: float = 0
     unit: str = ""
     description: Optional[str] = None
     frequency: str
@@ -400,11 +1798,53 @@ class Habit(BaseModel):
 class HabitUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
-    notification_time: Optional[str] = None 
+    notification_time: Optional[str] = None
     frequency: Optional[str] = None
     current_value: Optional[float] = None
 
 
+class ProgressPoint(BaseModel):
+    bucket: datetime
+    min: float
+    max: float
+    last: float
+    count: int
+
+
+class HabitImport(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    name: str
+    description: Optional[str] = None
+    frequency: str = "daily"
+    notification_time: Optional[str] = None
+    is_measurable: bool = False
+    target_value: float = 0
+    starting_point: float = 0
+    current_value: float = 0
+    unit: str = ""
+    is_active: bool = True
+    created_at: Optional[datetime] = None
+
+
+class CompletionImport(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    habit_id: str
+    completed_at: datetime
+    type: Optional[str] = None
+
+
+class FcmTokenStats(BaseModel):
+    token_suffix: str
+    created_at: Optional[str] = None
+    last_seen: Optional[str] = None
+    sent_count: int = 0
+    failure_count: int = 0
+    last_success_at: Optional[str] = None
+    last_failure_at: Optional[str] = None
+    last_error: Optional[str] = None
+
+
 class StatsResponse(BaseModel):
     xp: int
     level: int
@@ -440,10 +1880,8 @@ class SystemLog(BaseModel):
 
 
 @api_router.post("/auth/register")
-async def register(data: UserRegister):
-    # Check if user exists
-    if await db.users.find_one({"email": data.email}):
-        raise HTTPException(400, "Email exists")
+async def register(data: UserRegister, request: Request):
+    enforce_rate_limit("register", request, data.email)
 
     uid = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
@@ -452,34 +1890,42 @@ async def register(data: UserRegister):
     user = {
         "id": uid,
         "email": data.email,
-        "password_hash": hash_password(data.password),
+        "email_norm": data.email.lower(),
+        "password_hash": await run_hash_op("register", hash_password, data.password),
         "is_admin": False,
         "xp": 0,
-        "level": 1,
+        "level": calculate_level(0),
         "shields": 0,
         "current_streak": 0,
         "longest_streak": 0,
-        "badges": ["Beginner"],
+        "badges": get_badges(0),
         "created_at": now,
         "last_active": now,
         "phone": data.phone,
+        "timezone": get_zone(data.timezone).key,
     }
 
-    await db.users.insert_one(user)
+    # The unique index on email_norm is the duplicate check
+    try:
+        await db.users.insert_one(user)
+    except DuplicateKeyError:
+        raise HTTPException(400, "Email exists")
 
     # Prepare clean response (remove sensitive data)
     clean_user = {k: v for k, v in user.items() if k not in ["password_hash", "_id"]}
-    clean_user["title"] = get_user_title(1)
-
-    await log_event(clean_user, "REGISTER")
+    clean_user["title"] = get_user_title(user["level"])
 
     return {"token": create_access_token({"sub": uid}), "user": clean_user}
 
 
 @api_router.post("/auth/login")
-async def login(data: UserLogin):
-    user = await db.users.find_one({"email": data.email})
-    if not user or not verify_password(data.password, user["password_hash"]):
+async def login(data: UserLogin, request: Request):
+    enforce_rate_limit("login", request, data.email)
+
+    user = await db.users.find_one({"email_norm": data.email.lower()})
+    if not user or not await run_hash_op(
+        "login", verify_password, data.password, user["password_hash"]
+    ):
         raise HTTPException(401, "Invalid credentials")
 
     clean_user = {k: v for k, v in user.items() if k not in ["password_hash", "_id"]}
@@ -500,6 +1946,12 @@ async def me(user: dict = Depends(get_current_user)):
     user["title"] = get_user_title(user.get("level", 1))
 
     user["shields"] = user.get("shields", 0)
+
+    # Most recently seen device token, so the client can show link state
+    latest = await db.fcm_tokens.find_one(
+        {"user_id": user["id"]}, {"_id": 0, "token": 1}, sort=[("last_seen", -1)]
+    )
+    user["fcm_token"] = latest["token"] if latest else None
     return user
 
 
@@ -519,84 +1971,143 @@ async def set_username(data: dict, user: dict = Depends(get_current_user)):
             status_code=400, detail="Invalid characters. Only A-Z and 0-9 allowed."
         )
 
-    # Check for duplicates (existing logic)
-    existing_user = await db.users.find_one(
-        {
-            "username": {"$regex": f"^{new_username}$", "$options": "i"},
-            "id": {"$ne": user["id"]},
-        }
-    )
-
-    if existing_user:
+    # The unique index on username_norm rejects case-insensitive duplicates
+    try:
+        await db.users.update_one(
+            {"id": user["id"]},
+            {"$set": {"username": new_username, "username_norm": new_username.lower()}},
+        )
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Username already claimed.")
 
-    await db.users.update_one({"id": user["id"]}, {"$set": {"username": new_username}})
     return {"message": "Success", "username": new_username}
 
 
+@api_router.patch("/auth/timezone")
+async def set_timezone(data: dict, user: dict = Depends(get_current_user)):
+    """Sets the user's IANA time zone and re-times all of their reminders."""
+    tz_name = data.get("timezone", "").strip()
+    try:
+        tz = ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(400, "Unknown time zone")
+
+    await db.users.update_one({"id": user["id"]}, {"$set": {"timezone": tz.key}})
+
+    habits = await db.habits.find(
+        {"user_id": user["id"], "is_active": True},
+        {"_id": 1, "frequency": 1, "notification_time": 1, "created_at": 1},
+    ).to_list(1000)
+    if habits:
+        await db.habits.bulk_write(
+            [
+                UpdateOne({"_id": h["_id"]}, {"$set": schedule_fields(h, tz.key)})
+                for h in habits
+            ],
+            ordered=False,
+        )
+
+    return {"message": "Success", "timezone": tz.key}
+
+
+@api_router.get("/users/search")
+async def search_users(q: str, limit: int = 10, user: dict = Depends(get_current_user)):
+    """Username prefix search, served by the username_norm index."""
+    if not re.match("^[a-zA-Z0-9]+$", q):
+        raise HTTPException(400, "Invalid characters. Only A-Z and 0-9 allowed.")
+
+    limit = max(1, min(limit, 20))
+    # Anchored, case-sensitive prefix regex on the lowercased field -> index range scan
+    return (
+        await db.users.find(
+            {"username_norm": {"$regex": f"^{re.escape(q.lower())}"}},
+            {"_id": 0, "username": 1, "level": 1, "xp": 1},
+        )
+        .sort("username_norm", 1)
+        .limit(limit)
+        .to_list(limit)
+    )
+
+
 @api_router.post("/auth/fcm-token")
 async def save_fcm(data: dict, user: dict = Depends(get_current_user)):
     if not data.get("token"):
         raise HTTPException(400, "Token missing")
 
-    await db.users.update_one(
-        {"id": user["id"]}, {"$set": {"fcm_token": data["token"]}}
+    # One document per device; re-registering a token moves it to this user
+    now = datetime.now(timezone.utc).isoformat()
+    await db.fcm_tokens.update_one(
+        {"token": data["token"]},
+        {
+            "$set": {"user_id": user["id"], "last_seen": now},
+            "$setOnInsert": new_token_stats(now),
+        },
+        upsert=True,
     )
     return {"message": "Token saved"}
 
 
 @api_router.delete("/auth/fcm-token")
-async def remove_fcm(user: dict = Depends(get_current_user)):
-    """Removes the FCM token so notifications stop."""
-    await db.users.update_one({"id": user["id"]}, {"$unset": {"fcm_token": ""}})
+async def remove_fcm(
+    token: Optional[str] = None, user: dict = Depends(get_current_user)
+):
+    """Removes one device token (?token=...) or, without it, all of them."""
+    query = {"user_id": user["id"]}
+    if token:
+        query["token"] = token
+    await db.fcm_tokens.delete_many(query)
     return {"message": "Notifications Disabled"}
 
 
+@api_router.get("/auth/fcm-tokens", response_model=List[FcmTokenStats])
+async def list_fcm_tokens(user: dict = Depends(get_current_user)):
+    """Per-device delivery stats. Tokens are masked to their last 8 characters."""
+    tokens = (
+        await db.fcm_tokens.find({"user_id": user["id"]}, {"_id": 0, "user_id": 0})
+        .sort("last_seen", -1)
+        .to_list(100)
+    )
+    for t in tokens:
+        t["token_suffix"] = t.pop("token")[-8:]
+    return tokens
+
+
 # --- EVOLUTION & SHOP ROUTES ---
 
 
 @api_router.post("/shop/buy-shield")
 async def buy_shield(user: dict = Depends(get_current_user)):
-    SHIELD_COST = 200
-    current_xp = user.get("xp", 0)
-
-    if current_xp < SHIELD_COST:
+    SHIELD_COST = get_progression_rules().shield_cost
+
+    # Balance check and debit in one write; level/badges follow via projection
+    updated = await db.users.find_one_and_update(
+        {"id": user["id"], "xp": {"$gte": SHIELD_COST}},
+        {"$inc": {"xp": -SHIELD_COST, "shields": 1}},
+        projection={"_id": 0, "xp": 1, "shields": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated:
         raise HTTPException(
             status_code=400,
             detail=f"Insufficient XP. Shield requires {SHIELD_COST} XP.",
         )
 
-    new_xp = current_xp - SHIELD_COST
-
-    await db.users.update_one(
-        {"id": user["id"]},
-        {
-            "$set": {
-                "xp": new_xp,
-                "level": calculate_level(new_xp),
-                "badges": get_badges(new_xp),
-            },
-            "$inc": {"shields": 1},
-        },
-    )
-
     await log_event(user, "SHOP_PURCHASE: STREAK_SHIELD")
 
     return {
         "message": "Shield Secured",
-        "new_xp": new_xp,
-        "shields": user.get("shields", 0) + 1,
+        "new_xp": updated["xp"],
+        "shields": updated["shields"],
     }
 
 
 @api_router.get("/stats", response_model=StatsResponse)
 async def get_stats(user: dict = Depends(get_current_user)):
+    """
+    Pure read: shields and streak decay are applied by the nightly rollover job,
+    and streaks/level/badges are kept current by the projections.
+    """
     try:
-        # Check shield before calculating stats
-        if user.get("shields", 0) > 0:
-            await apply_shield_protection(user["id"])
-            user = await db.users.find_one({"id": user["id"]}, {"_id": 0})
-
         today_start = datetime.now(timezone.utc).replace(
             hour=0, minute=0, second=0, microsecond=0
         )
@@ -604,25 +2115,23 @@ async def get_stats(user: dict = Depends(get_current_user)):
         user_xp = user.get("xp", 0)
         user_level = user.get("level", 1)
 
-        cur_streak, long_streak = await update_streaks(user["id"])
-
-        await db.users.update_one(
-            {"id": user["id"]},
-            {"$set": {"current_streak": cur_streak, "longest_streak": long_streak}},
-        )
+        # Maintained by the habits projection; counted directly until first set
+        active_habits = user.get("active_habits")
+        if active_habits is None:
+            active_habits = await db.habits.count_documents(
+                {"user_id": user["id"], "is_active": True}
+            )
 
         return StatsResponse(
             xp=user_xp,
             level=user_level,
             total_points=user_xp,
-            current_streak=cur_streak,
-            longest_streak=long_streak,
+            current_streak=user.get("current_streak", 0),
+            longest_streak=user.get("longest_streak", 0),
             badges=user.get("badges", ["Beginner"]),
             shields=user.get("shields", 0),
             title=get_user_title(user_level),
-            total_habits=await db.habits.count_documents(
-                {"user_id": user["id"], "is_active": True}
-            ),
+            total_habits=active_habits,
             completed_today=await db.habit_completions.count_documents(
                 {
                     "user_id": user["id"],
@@ -691,6 +2200,53 @@ async def admin_logs(user: dict = Depends(get_admin_user)):
     return await db.system_logs.find({}, {"_id": 0}).sort("timestamp", -1).to_list(1000)
 
 
+@api_router.get("/admin/rate-limits")
+async def admin_rate_limits(user: dict = Depends(get_admin_user)):
+    """Rejection counters for the auth limiters since process start."""
+    return {
+        "rejections": dict(rate_limit_rejections),
+        "hash_concurrency": HASH_CONCURRENCY,
+        "hash_slots_saturated": hash_slots.locked(),
+    }
+
+
+@api_router.post("/admin/progression/recompute", status_code=202)
+async def admin_recompute_progression(user: dict = Depends(get_admin_user)):
+    """
+    Starts re-applying the current progression tables to every stored user.
+    Runs in the background; poll GET on the same path for its status.
+    """
+    stale = (datetime.now(timezone.utc) - JOB_LOCK_STALE).isoformat()
+    running = await db.job_locks.find_one(
+        {
+            "_id": "progression_recompute",
+            "status": "started",
+            "started_at": {"$gte": stale},
+        }
+    )
+    if running:
+        raise HTTPException(409, "Recompute already running")
+
+    start_background_task(recompute_progression(), "progression")
+    await log_event(user, "PROGRESSION_RECOMPUTE")
+    return {"status": "started", "version": get_progression_rules().version}
+
+
+@api_router.get("/admin/progression/recompute")
+async def admin_recompute_status(user: dict = Depends(get_admin_user)):
+    """Status of the latest progression recompute run."""
+    lock = await db.job_locks.find_one({"_id": "progression_recompute"})
+    if not lock:
+        return {"status": "never_run", "version": get_progression_rules().version}
+    return {
+        "status": lock.get("status"),
+        "version": lock.get("key"),
+        "started_at": lock.get("started_at"),
+        "finished_at": lock.get("finished_at"),
+        "result": lock.get("result"),
+    }
+
+
 @api_router.delete("/admin/users/{uid}")
 async def delete_user(uid: str, user: dict = Depends(get_admin_user)):
     target = await db.users.find_one({"id": uid})
@@ -701,6 +2257,11 @@ async def delete_user(uid: str, user: dict = Depends(get_admin_user)):
     await db.users.delete_one({"id": uid})
     await db.habits.delete_many({"user_id": uid})
     await db.habit_completions.delete_many({"user_id": uid})
+    await db.habits_archive.delete_many({"user_id": uid})
+    await db.habit_completions_archive.delete_many({"user_id": uid})
+    await db.habit_progress.delete_many({"meta.user_id": uid})
+    await db.fcm_tokens.delete_many({"user_id": uid})
+    await db.push_retries.delete_many({"user_id": uid})
 
     return {"message": "Deleted"}
 
@@ -732,9 +2293,14 @@ async def create_habit(data: HabitCreate, user: dict = Depends(get_current_user)
         "is_active": True,
         "created_at": datetime.now(timezone.utc).isoformat(),
     }
+    habit.update(schedule_fields(habit, user.get("timezone")))
     await db.habits.insert_one(habit)
     if "_id" in habit:
         del habit["_id"]
+
+    if habit["is_measurable"]:
+        await record_progress(habit, habit["current_value"])
+
     return habit
 
 
@@ -749,6 +2315,8 @@ async def update_habit(
     )
     if not res:
         raise HTTPException(404, "Not found")
+
+    await reschedule_habit(res, user.get("timezone"))
     return {k: v for k, v in res.items() if k != "_id"}
 
 
@@ -759,19 +2327,143 @@ async def patch_habit(
     data = {k: v for k, v in update_data.dict().items() if v is not None}
 
     if data:
-        await db.habits.update_one({"id": hid, "user_id": user["id"]}, {"$set": data})
+        habit = await db.habits.find_one_and_update(
+            {"id": hid, "user_id": user["id"]},
+            {"$set": data},
+            return_document=ReturnDocument.AFTER,
+        )
+        # Keep history instead of only the latest value
+        if habit and habit.get("is_measurable") and "current_value" in data:
+            await record_progress(habit, data["current_value"])
+
+        if habit and ("notification_time" in data or "frequency" in data):
+            await reschedule_habit(habit, user.get("timezone"))
 
     return {"status": "success"}
 
 
+# Approximate bucket widths, only used to bound the number of buckets returned
+PROGRESS_BUCKET_SECONDS = {
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+}
+MAX_PROGRESS_BUCKETS = 1000
+
+
+@api_router.get("/habits/{hid}/progress", response_model=List[ProgressPoint])
+async def get_habit_progress(
+    hid: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    bucket: str = "day",
+    user: dict = Depends(get_current_user),
+):
+    """
+    Downsampled history of a measurable habit: min, max and last value per bucket.
+    Defaults to the last 30 days.
+    """
+    if bucket not in PROGRESS_BUCKET_SECONDS:
+        raise HTTPException(
+            400, f"Invalid bucket. Use one of: {', '.join(PROGRESS_BUCKET_SECONDS)}"
+        )
+
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=30)
+    # Treat naive timestamps as UTC
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+
+    if start >= end:
+        raise HTTPException(400, "'from' must be before 'to'")
+    bucket_count = (end - start).total_seconds() / PROGRESS_BUCKET_SECONDS[bucket]
+    if bucket_count > MAX_PROGRESS_BUCKETS:
+        raise HTTPException(400, "Range too large for this bucket size")
+
+    pipeline = [
+        {
+            "$match": {
+                "meta.habit_id": hid,
+                "meta.user_id": user["id"],
+                "ts": {"$gte": start, "$lt": end},
+            }
+        },
+        {"$sort": {"ts": 1}},
+        {
+            "$group": {
+                "_id": {"$dateTrunc": {"date": "$ts", "unit": bucket}},
+                "min": {"$min": "$value"},
+                "max": {"$max": "$value"},
+                "last": {"$last": "$value"},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$sort": {"_id": 1}},
+        {
+            "$project": {
+                "_id": 0,
+                "bucket": "$_id",
+                "min": 1,
+                "max": 1,
+                "last": 1,
+                "count": 1,
+            }
+        },
+    ]
+    return await db.habit_progress.aggregate(pipeline).to_list(MAX_PROGRESS_BUCKETS)
+
+
 @api_router.delete("/habits/{hid}")
 async def delete_habit(hid: str, user: dict = Depends(get_current_user)):
     await db.habits.update_one(
-        {"id": hid, "user_id": user["id"]}, {"$set": {"is_active": False}}
+        {"id": hid, "user_id": user["id"]},
+        {
+            "$set": {
+                "is_active": False,
+                # Starts the clock for the archival job
+                "deactivated_at": datetime.now(timezone.utc).isoformat(),
+            }
+        },
     )
     return {"message": "Deleted"}
 
 
+@api_router.post("/habits/{hid}/restore", response_model=Habit)
+async def restore_habit(hid: str, user: dict = Depends(get_current_user)):
+    """Brings back a deleted habit, whether still soft-deleted or already archived."""
+    query = {"id": hid, "user_id": user["id"]}
+
+    archived = await db.habits_archive.find_one(query)
+    if archived:
+        await move_documents(
+            db.habit_completions_archive,
+            db.habit_completions,
+            {"habit_id": hid, "user_id": user["id"]},
+            ARCHIVE_BATCH_SIZE,
+        )
+        archived.pop("archived_at", None)
+        try:
+            await db.habits.insert_one(archived)
+        except DuplicateKeyError:
+            pass  # Restored before; just reactivate below
+        await db.habits_archive.delete_one({"_id": archived["_id"]})
+
+    habit = await db.habits.find_one_and_update(
+        query,
+        {"$set": {"is_active": True}, "$unset": {"deactivated_at": ""}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not habit:
+        raise HTTPException(404, "Not found")
+
+    await reschedule_habit(habit, user.get("timezone"))
+    return habit
+
+
 # --- COMPLETION ROUTES ---
 
 
@@ -796,8 +2488,9 @@ async def get_weekly_completions(user: dict = Depends(get_current_user)):
 @api_router.post("/habits/{hid}/complete")
 async def complete_habit(hid: str, user: dict = Depends(get_current_user)):
     """
-    Marks a habit as complete for today.
-    Updates XP, Level, Streaks, and Badges.
+    Marks a habit as complete for today. XP, level, streaks and badges are
+    applied asynchronously by the projection worker; the response carries
+    the expected values so the client can update immediately.
     """
     today = datetime.now(timezone.utc).isoformat()[:10]
 
@@ -807,7 +2500,7 @@ async def complete_habit(hid: str, user: dict = Depends(get_current_user)):
     ):
         raise HTTPException(400, "Already completed")
 
-    xp_reward = 20
+    xp_reward = get_progression_rules().completion_xp
 
     # Record Completion
     await db.habit_completions.insert_one(
@@ -817,26 +2510,11 @@ async def complete_habit(hid: str, user: dict = Depends(get_current_user)):
             "user_id": user["id"],
             "completed_at": datetime.now(timezone.utc).isoformat(),
             "xp_earned": xp_reward,
+            "projected": False,  # Picked up by the completions projection
         }
     )
 
-    # Update User Stats
     new_xp = user.get("xp", 0) + xp_reward
-    cur, lon = await update_streaks(user["id"])
-
-    await db.users.update_one(
-        {"id": user["id"]},
-        {
-            "$set": {
-                "xp": new_xp,
-                "level": calculate_level(new_xp),
-                "current_streak": cur,
-                "longest_streak": max(lon, user.get("longest_streak", 0)),
-                "badges": get_badges(new_xp),
-                "last_active": datetime.now(timezone.utc).isoformat(),
-            }
-        },
-    )
 
     return {
         "message": "Completed",
@@ -846,6 +2524,246 @@ async def complete_habit(hid: str, user: dict = Depends(get_current_user)):
     }
 
 
+# --- DATA EXPORT & IMPORT ROUTES ---
+
+EXPORT_FORMAT_VERSION = 1
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_ERRORS = 50
+IMPORT_MAX_HABITS = 500
+
+
+def _to_utc_iso(value: datetime) -> str:
+    """Normalizes to the aware-UTC ISO strings stored everywhere else."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+
+@api_router.get("/data/export")
+async def export_data(user: dict = Depends(get_current_user)):
+    """
+    Streams the user's habits, then completions, as NDJSON.
+    Cursors are iterated directly, so memory stays flat regardless of history size.
+    """
+    uid = user["id"]
+
+    async def stream():
+        yield json.dumps(
+            {
+                "type": "meta",
+                "version": EXPORT_FORMAT_VERSION,
+                "exported_at": datetime.now(timezone.utc).isoformat(),
+            }
+        ) + "\n"
+
+        # Archived history is part of the user's data too
+        hidden = {"_id": 0, "user_id": 0, "archived_at": 0}
+
+        for collection in (db.habits, db.habits_archive):
+            habits = collection.find({"user_id": uid}, hidden)
+            async for habit in habits.batch_size(IMPORT_CHUNK_SIZE):
+                yield json.dumps({"type": "habit", **habit}, default=str) + "\n"
+
+        for collection in (db.habit_completions, db.habit_completions_archive):
+            completions = collection.find({"user_id": uid}, hidden).sort(
+                "completed_at", 1
+            )
+            async for comp in completions.batch_size(IMPORT_CHUNK_SIZE):
+                yield json.dumps({"type": "completion", **comp}, default=str) + "\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="habits-export.ndjson"'},
+    )
+
+
+async def _iter_ndjson_lines(request: Request):
+    """Yields non-empty lines from the request body without buffering it whole."""
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if pending.strip():
+        yield pending
+
+
+async def _insert_chunk(collection, docs: list) -> int:
+    """insert_many(ordered=False); returns how many documents actually landed."""
+    if not docs:
+        return 0
+    try:
+        result = await collection.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        return e.details.get("nInserted", 0)
+
+
+async def _drop_existing_days(uid: str, completions: list) -> list:
+    """Filters out completions for (habit, day) pairs the user already has."""
+    if not completions:
+        return completions
+    # Only this chunk's date range can collide
+    days = sorted(c["completed_at"][:10] for c in completions)
+    until = (datetime.fromisoformat(days[-1]) + timedelta(days=1)).date().isoformat()
+    query = {
+        "user_id": uid,
+        "habit_id": {"$in": list({c["habit_id"] for c in completions})},
+        "completed_at": {"$gte": days[0], "$lt": until},
+    }
+    existing = set()
+    for collection in (db.habit_completions, db.habit_completions_archive):
+        async for c in collection.find(
+            query, {"_id": 0, "habit_id": 1, "completed_at": 1}
+        ):
+            existing.add((c["habit_id"], c["completed_at"][:10]))
+    return [
+        c
+        for c in completions
+        if (c["habit_id"], c["completed_at"][:10]) not in existing
+    ]
+
+
+@api_router.post("/data/import")
+async def import_data(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Imports an NDJSON file in the export format. Habits must appear before the
+    completions that reference them. Records are validated and written in chunks;
+    streaks are recomputed once at the end.
+
+    Imported history earns no XP and shield rows are dropped, so importing
+    can't mint XP or shields. Re-importing is idempotent: habits are matched by
+    their id or the source id they were imported from, and a habit-day that
+    already has a completion is skipped.
+    """
+    uid = user["id"]
+
+    # Exported id (or earlier import's source id) -> id in this account
+    # Archived habits count too, so re-importing an export doesn't revive them
+    habit_ids = {}
+    for collection in (db.habits, db.habits_archive):
+        async for h in collection.find(
+            {"user_id": uid}, {"_id": 0, "id": 1, "source_id": 1}
+        ):
+            habit_ids[h["id"]] = h["id"]
+            if h.get("source_id"):
+                habit_ids[h["source_id"]] = h["id"]
+
+    seen_days = set()  # (habit_id, date): one completion per habit per day
+    habits, completions, errors = [], [], []
+    counts = {"habits": 0, "completions": 0, "skipped": 0, "rejected": 0}
+
+    def add_error(line_no: int, message: str):
+        counts["rejected"] += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"line": line_no, "error": message})
+
+    async def flush_completions(batch: list):
+        fresh = await _drop_existing_days(uid, batch)
+        counts["skipped"] += len(batch) - len(fresh)
+        counts["completions"] += await _insert_chunk(db.habit_completions, fresh)
+
+    line_no = 0
+    new_habits = 0
+    async for line in _iter_ndjson_lines(request):
+        line_no += 1
+        try:
+            record = json.loads(line)
+            kind = record.get("type")
+
+            if kind == "habit":
+                habit = HabitImport(**record)
+                if habit.id in habit_ids:
+                    counts["skipped"] += 1  # Already in this account
+                    continue
+                if new_habits >= IMPORT_MAX_HABITS:
+                    raise ValueError(f"more than {IMPORT_MAX_HABITS} new habits")
+                new_habits += 1
+
+                new_id = str(uuid.uuid4())
+                habit_ids[habit.id] = new_id
+                doc = {
+                    **habit.model_dump(exclude={"id", "created_at"}),
+                    "id": new_id,
+                    "source_id": habit.id,
+                    "user_id": uid,
+                    "created_at": _to_utc_iso(
+                        habit.created_at or datetime.now(timezone.utc)
+                    ),
+                }
+                doc.update(schedule_fields(doc, user.get("timezone")))
+                habits.append(doc)
+
+            elif kind == "completion":
+                comp = CompletionImport(**record)
+                if comp.type == "shield":
+                    counts["skipped"] += 1  # Shields are only earned, never imported
+                    continue
+
+                habit_id = habit_ids.get(comp.habit_id)
+                if not habit_id:
+                    raise ValueError("completion references an unknown habit")
+
+                completed_at = _to_utc_iso(comp.completed_at)
+                if completed_at > datetime.now(timezone.utc).isoformat():
+                    raise ValueError("completion is in the future")
+
+                day_key = (habit_id, completed_at[:10])
+                if day_key in seen_days:
+                    raise ValueError("duplicate completion for that day")
+                seen_days.add(day_key)
+
+                completions.append(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "habit_id": habit_id,
+                        "user_id": uid,
+                        "completed_at": completed_at,
+                        # History only: XP is earned by completing, not importing
+                        "xp_earned": 0,
+                        "imported": True,
+                    }
+                )
+
+            elif kind != "meta":
+                raise ValueError(f"unknown record type: {kind}")
+
+        except Exception as e:
+            add_error(line_no, str(e))
+            continue
+
+        if len(habits) >= IMPORT_CHUNK_SIZE:
+            counts["habits"] += await _insert_chunk(db.habits, habits)
+            habits = []
+        if len(completions) >= IMPORT_CHUNK_SIZE:
+            await flush_completions(completions)
+            completions = []
+
+    counts["habits"] += await _insert_chunk(db.habits, habits)
+    await flush_completions(completions)
+
+    # --- One recompute for the whole import ---
+    if counts["completions"]:
+        cur, lon = await update_streaks(uid)
+        await db.users.update_one(
+            {"id": uid},
+            {"$set": {"current_streak": cur}, "$max": {"longest_streak": lon}},
+        )
+
+    await log_event(user, f"DATA_IMPORT: {counts['habits']}H/{counts['completions']}C")
+
+    return {
+        "habits_imported": counts["habits"],
+        "completions_imported": counts["completions"],
+        "skipped": counts["skipped"],
+        "rejected": counts["rejected"],
+        "errors": errors,
+    }
+
+
 # --- SYSTEM STARTUP & MIDDLEWARE ---
 
 app.include_router(api_router)
@@ -860,17 +2778,78 @@ app.add_middleware(
 )
 
 
+# Strong references to fire-and-forget tasks; asyncio only keeps weak ones
+app.state.background_tasks = set()
+
+
+def _background_task_done(task: asyncio.Task):
+    app.state.background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(
+            f"❌ BACKGROUND TASK {task.get_name()} FAILED: {task.exception()!r}",
+            flush=True,
+        )
+
+
+def start_background_task(coro, name: str) -> asyncio.Task:
+    """create_task that keeps a handle and reports failures."""
+    task = asyncio.create_task(coro, name=name)
+    app.state.background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+
 @app.on_event("startup")
 async def startup():
     """
     Initializes the Scheduler on startup.
     Uses 'cron' to align with wall-clock time for accurate notifications.
     """
+    # Fail fast on a malformed PROGRESSION_RULES_PATH file
+    get_progression_rules()
+
+    await backfill_normalized_fields()
+    await ensure_indexes()
+    await migrate_legacy_fcm_tokens()
+    await backfill_habit_schedules()
+
+    # Only does work when the rules version changed since the last run
+    start_background_task(recompute_progression(force=False), "progression")
+
+    # Catch up on today's rollover if the process was down at 00:05
+    start_background_task(run_day_rollover(), "rollover")
+
+    # Set PROJECTIONS_IN_PROCESS=0 when running 'python server.py projections'
+    # as a separate worker instead. Either way a lease keeps it to one process.
+    if os.environ.get("PROJECTIONS_IN_PROCESS", "1") == "1":
+        await require_replica_set()
+        start_background_task(run_projections(), "projections")
+
     scheduler = AsyncIOScheduler()
 
     # Check every 10 seconds to ensure no minute is skipped
     scheduler.add_job(check_and_send_notifications, "cron", second="0")
 
+    # Move long-deleted habits out of the hot collections
+    scheduler.add_job(
+        compact_inactive_habits, "cron", hour="0", minute="30", timezone=timezone.utc
+    )
+
+    # Transient FCM failures queued with backoff
+    scheduler.add_job(process_push_retries, "interval", seconds=30)
+
+    # Nightly shield / streak-decay pass, just after the UTC day boundary. The
+    # later hourly runs are no-ops once the day is done and otherwise retry a
+    # crashed or missed run.
+    scheduler.add_job(
+        run_day_rollover,
+        "cron",
+        minute="5",
+        timezone=timezone.utc,
+        misfire_grace_time=3600,
+        coalesce=True,
+    )
+
     scheduler.start()
     print(
         "🚀 SYSTEM ONLINE: Scheduler set to 1-Minute Intervals (Fires at :00)",
@@ -878,7 +2857,31 @@ async def startup():
     )
 
 
+# --- CLI ---
+# python server.py               -> run the API
+# python server.py <command>     -> run a one-off maintenance job
+
+CLI_COMMANDS = {
+    "migrate-users": backfill_normalized_fields,
+    "list-email-collisions": list_email_collisions,
+    "ensure-indexes": ensure_indexes,
+    "migrate-fcm-tokens": migrate_legacy_fcm_tokens,
+    "schedule-habits": backfill_habit_schedules,
+    "day-rollover": run_day_rollover,
+    "recompute-progression": recompute_progression,
+    "projections": run_projections,
+    "replay-projections": replay_projections,
+    "compact-habits": compact_inactive_habits,
+}
+
+
 if __name__ == "__main__":
-    import uvicorn
+    if len(sys.argv) > 1:
+        command = CLI_COMMANDS.get(sys.argv[1])
+        if not command:
+            sys.exit(f"Unknown command. Available: {', '.join(CLI_COMMANDS)}")
+        asyncio.run(command())
+    else:
+        import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+        uvicorn.run(app, host="0.0.0.0", port=8000)